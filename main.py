@@ -1,18 +1,59 @@
+import asyncio
+import codecs
 import os
 import re
+import threading
 import time
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from io import BytesIO
 from urllib.parse import urljoin, urlparse
-from typing import List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-import requests
-from bs4 import BeautifulSoup
-from fastapi import FastAPI, HTTPException
+import httpx
+from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from lxml import etree
+from lxml import html as lxml_html
+from bson import ObjectId
+from bson.errors import InvalidId
 from pydantic import BaseModel
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
 
 from database import db, create_document, get_documents
 
-app = FastAPI(title="AI SEO Audit API", version="1.0.0")
+def create_indexes():
+    try:
+        # audit tasks are always looked up by crawl_id; the compound key also
+        # serves crawl_id-only queries as a prefix
+        db["audittask"].create_index([("crawl_id", 1), ("status", 1)])
+    except Exception:
+        pass
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one pooled client for all outbound fetches
+    app.state.http = httpx.AsyncClient(
+        timeout=6,
+        follow_redirects=True,
+        headers={"User-Agent": "SEO-Audit-Bot/1.0"},
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    )
+    if db is not None:
+        # create_index blocks until server selection times out when Mongo is
+        # unreachable, so don't hold up startup waiting for it
+        threading.Thread(target=create_indexes, daemon=True).start()
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
+app = FastAPI(title="AI SEO Audit API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -31,21 +72,136 @@ class TaskIdResponse(BaseModel):
     task_id: str
 
 
-def normalize_url(base: str, link: str) -> Optional[str]:
+@lru_cache(maxsize=4096)
+def normalize_url(base: str, link: str) -> Optional[Tuple[str, str]]:
+    # returns (url, netloc) so callers can check the origin without re-parsing
     try:
         u = urljoin(base, link)
         parsed = urlparse(u)
         if parsed.scheme in {"http", "https"}:
             # strip fragments
-            return parsed._replace(fragment="").geturl()
+            return parsed._replace(fragment="").geturl(), parsed.netloc
     except Exception:
         return None
     return None
 
 
-def same_origin(a: str, b: str) -> bool:
-    pa, pb = urlparse(a), urlparse(b)
-    return pa.netloc == pb.netloc
+# hrefs that can never yield a crawlable page; rejected before any URL parsing
+_SKIP_HREF_PREFIXES = ("#", "mailto:", "tel:", "javascript:")
+
+
+def collect_links(base: str, hrefs: Iterable[str], seed_netloc: str, seen: Set[str], limit: int) -> List[str]:
+    # new same-origin links found on `base`, at most `limit`; `seen` is updated in place
+    found: List[str] = []
+    for href in hrefs:
+        if len(found) >= limit:
+            break
+        if not href or href.startswith(_SKIP_HREF_PREFIXES):
+            continue
+        normalized = normalize_url(base, href)
+        if normalized is None:
+            continue
+        nu, netloc = normalized
+        if netloc == seed_netloc and nu not in seen:
+            seen.add(nu)
+            found.append(nu)
+    return found
+
+
+_META_CHARSET_RE = re.compile(rb"<meta[^>]+charset\s*=", re.IGNORECASE)
+_BOMS = {codecs.BOM_UTF8: "utf-8", codecs.BOM_UTF16_LE: "utf-16", codecs.BOM_UTF16_BE: "utf-16"}
+
+
+@lru_cache(maxsize=32)
+def _html_parser(encoding: Optional[str]):
+    return lxml_html.HTMLParser(encoding=encoding)
+
+
+def page_encoding(body: bytes, declared: Optional[str]) -> Optional[str]:
+    # The Content-Type charset wins if libxml2 knows it, then a BOM. Otherwise
+    # return None so lxml honours a <meta charset>; without one libxml2 would
+    # assume Latin-1, so use UTF-8.
+    if declared:
+        try:
+            _html_parser(declared)
+            return declared
+        except LookupError:
+            pass
+    for bom, encoding in _BOMS.items():
+        if body.startswith(bom):
+            return encoding
+    if _META_CHARSET_RE.search(body, 0, 4096):
+        return None
+    return "utf-8"
+
+
+def parse_html(body: bytes, encoding: Optional[str] = None):
+    parser = _html_parser(page_encoding(body, encoding))
+    try:
+        return lxml_html.document_fromstring(body, parser=parser)
+    except (etree.ParserError, etree.XMLSyntaxError):
+        # empty document
+        return lxml_html.Element("html")
+
+
+def iter_hrefs(body: bytes, encoding: Optional[str] = None) -> Iterator[str]:
+    # stream <a href> values, pruning everything parsed before each anchor so
+    # the tree only ever holds the path to the current one
+    try:
+        encoding = page_encoding(body, encoding)
+        for _, el in etree.iterparse(BytesIO(body), tag="a", html=True, encoding=encoding):
+            href = el.get("href")
+            el.clear()
+            node = el
+            while (parent := node.getparent()) is not None:
+                while node.getprevious() is not None:
+                    del parent[0]
+                node = parent
+            if href is not None:
+                yield href
+    except etree.XMLSyntaxError:
+        # empty or unparseable document
+        return
+
+
+# pages are truncated past this many (decompressed) bytes
+MAX_BODY_BYTES = 2_000_000
+
+# Recently fetched 200 pages, so auditing a URL the crawler just visited doesn't
+# download it again. Insertion-ordered, so the oldest entry is always first.
+FETCH_CACHE_TTL = 300
+FETCH_CACHE_SIZE = 64
+_FETCH_CACHE: Dict[str, Tuple[float, Tuple[int, bytes, Optional[str]]]] = {}
+
+
+async def fetch_page(url: str, timeout: float = 6, use_cache: bool = True) -> Tuple[int, bytes, Optional[str]]:
+    # use_cache=False always hits the network but still stores the result
+    now = time.monotonic()
+    cached = _FETCH_CACHE.get(url) if use_cache else None
+    if cached and now - cached[0] < FETCH_CACHE_TTL:
+        return cached[1]
+    # stream the body so huge pages can't blow up memory or parse time
+    client: httpx.AsyncClient = app.state.http
+    async with client.stream("GET", url, timeout=timeout) as r:
+        body = bytearray()
+        async for chunk in r.aiter_bytes():
+            body += chunk
+            if len(body) >= MAX_BODY_BYTES:
+                break
+        # only the header charset; parse_html/iter_hrefs fall back to the page's own <meta>
+        page = (r.status_code, bytes(body[:MAX_BODY_BYTES]), r.charset_encoding)
+    if r.status_code != 200:
+        # never replay a transient error
+        return page
+    _FETCH_CACHE.pop(url, None)
+    _FETCH_CACHE[url] = (time.monotonic(), page)
+    # drop expired entries and anything over the size cap, oldest first
+    while _FETCH_CACHE:
+        oldest = next(iter(_FETCH_CACHE))
+        if len(_FETCH_CACHE) <= FETCH_CACHE_SIZE and now - _FETCH_CACHE[oldest][0] < FETCH_CACHE_TTL:
+            break
+        del _FETCH_CACHE[oldest]
+    return page
 
 
 @app.get("/")
@@ -54,85 +210,119 @@ def root():
 
 
 @app.post("/api/crawl/start", response_model=TaskIdResponse)
-def start_crawl(payload: StartCrawlRequest):
+async def start_crawl(payload: StartCrawlRequest, background_tasks: BackgroundTasks):
     if not payload.url:
         raise HTTPException(400, "URL is required")
     # create crawl document
     from schemas import CrawlTask
 
     crawl = CrawlTask(seed_url=payload.url)
-    task_id = create_document("crawltask", crawl)
+    task_id = await run_in_threadpool(create_document, "crawltask", crawl)
+    # run the first crawl step after responding so status polls can stay read-only
+    background_tasks.add_task(first_crawl_step, task_id)
     return {"task_id": task_id}
 
 
-@app.get("/api/crawl/status")
-def crawl_status(task_id: str):
-    # fetch crawl task
-    docs = get_documents("crawltask", {"_id": {"$oid": task_id}})
-    # fallback: try string compare if viewer doesn't construct $oid
-    if not docs:
-        from bson import ObjectId
+async def first_crawl_step(task_id: str):
+    try:
+        await crawl_status(task_id, advance=True)
+    except Exception:
+        # the task stays pending; /api/crawl/advance can retry it
+        pass
+
+
+def load_crawl(task_id: str) -> Optional[dict]:
+    # fetch crawl task; only the first 100 urls are ever used, so don't pull the rest
+    projection = {"urls": {"$slice": 100}}
+    try:
+        oid = ObjectId(task_id)
+    except InvalidId:
+        return None
+    doc = db["crawltask"].find_one({"_id": oid}, projection)
+    if not doc:
+        # fallback for viewers that construct $oid themselves; only reached on a
+        # miss, since a real MongoDB server rejects it as an unknown operator
         try:
-            docs = get_documents("crawltask", {"_id": ObjectId(task_id)})
-        except Exception:
+            doc = db["crawltask"].find_one({"_id": {"$oid": task_id}}, projection)
+        except OperationFailure:
             pass
-    if not docs:
+    return doc
+
+
+@app.get("/api/crawl/status")
+async def crawl_status(task_id: str, advance: bool = False):
+    # pymongo is blocking, so keep it off the event loop
+    doc = await run_in_threadpool(load_crawl, task_id)
+    if not doc:
         raise HTTPException(404, "Task not found")
-    doc = docs[0]
-    # Do a lightweight crawler step each call to simulate progress
+    if not advance:
+        doc["_id"] = str(doc["_id"])
+        return doc
+    # Do a lightweight crawler step to simulate progress
     seed = doc.get("seed_url")
-    visited = set(doc.get("urls", [])[:100])
-    to_visit = []
-    if not visited:
-        to_visit = [seed]
+    seed_netloc = urlparse(seed or "").netloc
+    # dict keys keep the stored order while deduplicating
+    visited = dict.fromkeys(doc.get("urls", [])[:100])
+    to_visit = deque() if visited else deque([seed])
     # fetch at most a few pages to simulate progressive crawling
     new_urls: List[str] = list(visited)
+    seen = set(new_urls)
     steps = 0
     while to_visit and steps < 2 and len(new_urls) < 100:
-        current = to_visit.pop(0)
-        try:
-            r = requests.get(current, timeout=6, headers={"User-Agent": "SEO-Audit-Bot/1.0"})
-            if r.status_code != 200:
-                steps += 1
+        # fetch the remaining step budget concurrently
+        batch = [to_visit.popleft() for _ in range(min(len(to_visit), 2 - steps))]
+        steps += len(batch)
+        pages = await asyncio.gather(*(fetch_page(u, use_cache=False) for u in batch), return_exceptions=True)
+        for current, page in zip(batch, pages):
+            if isinstance(page, Exception):
                 continue
-            soup = BeautifulSoup(r.text, "html.parser")
-            for a in soup.find_all("a", href=True):
-                nu = normalize_url(current, a["href"]) or ""
-                if not nu:
-                    continue
-                if same_origin(seed, nu) and nu not in new_urls and len(new_urls) < 100:
-                    new_urls.append(nu)
-                    to_visit.append(nu)
-        except Exception:
-            pass
-        steps += 1
+            status_code, body, encoding = page
+            if status_code != 200:
+                continue
+            try:
+                # parsing is CPU-bound; lxml releases the GIL, so run it in the threadpool
+                found = await run_in_threadpool(
+                    collect_links, current, iter_hrefs(body, encoding), seed_netloc, seen, 100 - len(new_urls)
+                )
+                new_urls.extend(found)
+                to_visit.extend(found)
+            except Exception:
+                pass
     progress = min(100, len(new_urls) // 1)  # simple proxy
     # update document
+    changes = {"urls": new_urls, "total_found": len(new_urls), "progress": progress,
+               "status": "complete" if progress >= 100 else "in-progress"}
     try:
-        db["crawltask"].update_one(
-            {"_id": doc["_id"]},
-            {"$set": {"urls": new_urls, "total_found": len(new_urls), "progress": progress,
-                       "status": "complete" if progress >= 100 else "in-progress"}}
-        )
-    except Exception:
-        pass
-    # return latest
-    latest = db["crawltask"].find_one({"_id": doc["_id"]})
-    latest["_id"] = str(latest["_id"])
-    return latest
+        await run_in_threadpool(db["crawltask"].update_one, {"_id": doc["_id"]}, {"$set": changes})
+    except Exception as e:
+        raise HTTPException(500, f"Failed to save crawl progress: {str(e)[:120]}")
+    # return latest, merged locally instead of re-reading it
+    doc.update(changes)
+    doc["_id"] = str(doc["_id"])
+    return doc
+
+
+@app.post("/api/crawl/advance")
+async def advance_crawl(task_id: str):
+    return await crawl_status(task_id, advance=True)
 
 
 @app.get("/api/crawl/urls")
-def crawl_urls(task_id: str):
-    latest = crawl_status(task_id)
+async def crawl_urls(task_id: str):
+    latest = await crawl_status(task_id)
     return {"urls": latest.get("urls", [])}
 
 
 @app.post("/api/audit/start")
-def start_audit(task_id: str):
+async def start_audit(task_id: str):
     # create audit tasks for first 20 urls
-    crawl = crawl_status(task_id)
+    crawl = await crawl_status(task_id)
     urls: List[str] = crawl.get("urls", [])[:20]
+    created = await run_in_threadpool(create_audit_tasks, task_id, urls)
+    return {"created": created, "count": len(created)}
+
+
+def create_audit_tasks(task_id: str, urls: List[str]) -> List[str]:
     created = []
     for u in urls:
         try:
@@ -141,38 +331,45 @@ def start_audit(task_id: str):
             created.append(create_document("audittask", audit))
         except Exception:
             continue
-    return {"created": created, "count": len(created)}
+    return created
 
 
 @app.get("/api/audit/list")
-def audit_list(task_id: str):
-    tasks = get_documents("audittask", {"crawl_id": task_id})
-    # simulate progression: update a few tasks per call
-    updated = 0
-    for t in tasks[:5]:
-        if t.get("status") in {"complete", "error"}:
-            continue
-        url = t.get("url")
-        try:
-            score, report = run_basic_seo_checks(url)
-            db["audittask"].update_one({"_id": t["_id"]}, {"$set": {
-                "status": "complete",
-                "score": score,
-                "report": report
-            }})
-        except Exception as e:
-            db["audittask"].update_one({"_id": t["_id"]}, {"$set": {
-                "status": "error",
-                "error": str(e)[:120]
-            }})
-        updated += 1
-    tasks = get_documents("audittask", {"crawl_id": task_id})
+async def audit_list(task_id: str, advance: bool = False):
+    tasks = await run_in_threadpool(get_documents, "audittask", {"crawl_id": task_id})
+    if advance:
+        await run_pending_audits(tasks)
     # serialize ids
     for t in tasks:
         t["_id"] = str(t["_id"]) if t.get("_id") else t.get("_id")
     return {"tasks": tasks}
 
 
+@app.post("/api/audit/advance")
+async def advance_audits(task_id: str):
+    return await audit_list(task_id, advance=True)
+
+
+async def run_pending_audits(tasks: List[dict]):
+    # simulate progression: audit a few pending tasks per call, fetching them concurrently
+    pending = [t for t in tasks[:5] if t.get("status") not in {"complete", "error"}]
+    results = await asyncio.gather(
+        *(run_basic_seo_checks(t.get("url")) for t in pending), return_exceptions=True
+    )
+    ops = []
+    for t, result in zip(pending, results):
+        if isinstance(result, Exception):
+            changes = {"status": "error", "error": str(result)[:120]}
+        else:
+            score, report = result
+            changes = {"status": "complete", "score": score, "report": report}
+        ops.append(UpdateOne({"_id": t["_id"]}, {"$set": changes}))
+        # apply locally too so we don't have to re-read the collection
+        t.update(changes)
+    if ops:
+        await run_in_threadpool(db["audittask"].bulk_write, ops, ordered=False)
+
+
 @app.get("/api/audit/report")
 def audit_report(audit_id: str):
     from bson import ObjectId
@@ -188,22 +385,30 @@ def audit_report(audit_id: str):
 
 # Basic SEO checks used to produce a lightweight report
 
-def run_basic_seo_checks(url: str):
-    r = requests.get(url, timeout=8, headers={"User-Agent": "SEO-Audit-Bot/1.0"})
-    html = r.text
-    soup = BeautifulSoup(html, "html.parser")
-    title = (soup.title.string.strip() if soup.title and soup.title.string else None)
-    meta_desc = None
-    for m in soup.find_all("meta"):
-        if m.get("name", "").lower() == "description" and m.get("content"):
-            meta_desc = m["content"]
-            break
-    h1 = soup.find("h1")
-    images = soup.find_all("img")
+_META_DESC_XPATH = etree.XPath(
+    '//meta[translate(@name, "DESCRIPTION", "description")="description"]/@content',
+    smart_strings=False,
+)
+
+
+async def run_basic_seo_checks(url: str):
+    _, body, encoding = await fetch_page(url, timeout=8)
+    # keep the parse off the event loop
+    return await run_in_threadpool(analyze_page, body, encoding)
+
+
+def analyze_page(body: bytes, encoding: Optional[str] = None):
+    tree = parse_html(body, encoding)
+    title = (tree.findtext(".//title") or "").strip() or None
+    meta_desc = next((c for c in _META_DESC_XPATH(tree) if c), None)
+    has_h1 = tree.find(".//h1") is not None
+    images = tree.findall(".//img")
     imgs_without_alt = [img.get("src") for img in images if not img.get("alt")]
 
-    text = soup.get_text(" ")
-    word_count = len([w for w in re.findall(r"\w+", text) if w])
+    # script/style bodies aren't page copy; drop them (keeping tail text) before counting words
+    etree.strip_elements(tree, "script", "style", "template", with_tail=False)
+    # count per text node rather than joining the whole page into one string
+    word_count = sum(len(frag.split()) for frag in tree.itertext())
 
     score = 100
     deductions = 0
@@ -211,7 +416,7 @@ def run_basic_seo_checks(url: str):
         deductions += 20
     if not meta_desc:
         deductions += 15
-    if not h1:
+    if not has_h1:
         deductions += 10
     if len(imgs_without_alt) > 0:
         deductions += min(15, len(imgs_without_alt))
@@ -222,14 +427,14 @@ def run_basic_seo_checks(url: str):
     report = {
         "title": title,
         "meta_description": meta_desc,
-        "has_h1": bool(h1),
+        "has_h1": has_h1,
         "image_count": len(images),
         "images_missing_alt": len(imgs_without_alt),
         "word_count": word_count,
         "recommendations": [
             *([] if title else ["Add a descriptive, keyword-rich <title> tag (50-60 chars)"]),
             *([] if meta_desc else ["Provide a compelling meta description (~155 chars)"]),
-            *([] if h1 else ["Include a single clear H1 headline on the page"]),
+            *([] if has_h1 else ["Include a single clear H1 headline on the page"]),
             *([] if len(imgs_without_alt) == 0 else ["Add alt text to images for accessibility and SEO"]),
             *([] if word_count >= 200 else ["Increase on-page copy to at least 200-500 words"]),
         ],